@@ -1,8 +1,13 @@
 import numpy as np
-from skimage.filters import scharr_h, scharr_v, sobel_h, sobel_v, gaussian
 import cv2
 import matplotlib
 import matplotlib.pyplot as plt
+from numba import njit, prange
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
 
 
 def get_interest_points(image, feature_width):
@@ -45,36 +50,60 @@ def get_interest_points(image, feature_width):
     :orientation: an np array indicating the orientation of each interest point
 
     """
+    image = np.asarray(image, dtype=np.float32)
     Alpha = 0.03
     threshold = 0.005
-    stride = 2
-    sigma = 0.3
-    rows = image.shape[0]
-    columns = image.shape[1]
-    xs = []
-    ys = []
-    dx = cv2.Sobel(image, cv2.CV_8U, 1, 0, ksize=5)
-    dy = cv2.Sobel(image, cv2.CV_8U, 0, 1, ksize=5)
-    dx = gaussian(dx, sigma)
-    dy = gaussian(dy, sigma)
+    nms_size = 3
+    R = _harris_response(image, feature_width, Alpha)
+    # no window fits in the image
+    if R.size == 0:
+        return np.empty(0, int), np.empty(0, int)
+    # keep the local maxima of the response within nms_size windows, then check the threshold
+    local_max = cv2.dilate(R, np.ones((nms_size, nms_size), np.uint8)) == R
+    ys, xs = np.nonzero(local_max & (R > threshold))
+    xs = xs + int(feature_width / 2 - 1)
+    ys = ys + int(feature_width / 2 - 1)
+    return xs, ys
+
+
+def _harris_response(image, feature_width, Alpha):
+    """
+    Returns the Harris response R = det(H) - Alpha * trace(H)^2 of every (feature_width + 1)
+    square window that fits in the image, indexed by the window's top left corner.
+    Runs on the GPU through OpenCV's CUDA module when a CUDA device is available.
+    """
+    W = feature_width + 1
+    rows, columns = image.shape[:2]
+    if cv2.cuda.getCudaEnabledDeviceCount() > 0:
+        gpu_image = cv2.cuda_GpuMat()
+        gpu_image.upload(image)
+        harris = cv2.cuda.createHarrisCorner(cv2.CV_32FC1, W, 5, Alpha)
+        R = harris.compute(gpu_image).download()
+        # cornerHarris scales the derivatives by 1 / (2^(ksize - 1) * blockSize), swap that for
+        # the 1 / 255 used on the CPU, and move from centred windows to top left corners
+        R *= (16 * W / 255) ** 4
+        half = W // 2
+        return R[half:half + rows - feature_width, half:half + columns - feature_width]
+
+    # signed float gradients, scaled so threshold stays in the units of 8 bit gradients in [0, 1]
+    dx = cv2.Sobel(image, cv2.CV_32F, 1, 0, ksize=5, scale=1 / 255)
+    dy = cv2.Sobel(image, cv2.CV_32F, 0, 1, ksize=5, scale=1 / 255)
 
     dx2 = dx ** 2
     dy2 = dy ** 2
     dxy = dx * dy
-    # find ssd
-    for y in range(0, rows - feature_width, stride):
-        for x in range(0, columns - feature_width, stride):
-            Sxx = np.sum(dx2[y:y + feature_width + 1, x:x + feature_width + 1])
-            Syy = np.sum(dy2[y:y + feature_width + 1, x:x + feature_width + 1])
-            Sxy = np.sum(dxy[y:y + feature_width + 1, x:x + feature_width + 1])
-            detH = (Sxx * Syy) - (Sxy ** 2)
-            traceH = Sxx + Syy
-            R = detH - Alpha * (traceH ** 2)
-            # check the threshold
-            if R > threshold:
-                xs.append(x + int(feature_width / 2 - 1))
-                ys.append(y + int(feature_width / 2 - 1))
-    return np.asarray(xs), np.asarray(ys)
+    # find ssd, an unnormalized box filter anchored at the top left corner sums
+    # the (feature_width + 1) square window starting at each pixel
+    Sxx = cv2.boxFilter(dx2, cv2.CV_32F, (W, W), anchor=(0, 0), normalize=False, borderType=cv2.BORDER_REPLICATE)
+    Syy = cv2.boxFilter(dy2, cv2.CV_32F, (W, W), anchor=(0, 0), normalize=False, borderType=cv2.BORDER_REPLICATE)
+    Sxy = cv2.boxFilter(dxy, cv2.CV_32F, (W, W), anchor=(0, 0), normalize=False, borderType=cv2.BORDER_REPLICATE)
+    # drop the windows that run over the bottom / right edges
+    Sxx = Sxx[:-feature_width, :-feature_width]
+    Syy = Syy[:-feature_width, :-feature_width]
+    Sxy = Sxy[:-feature_width, :-feature_width]
+    detH = (Sxx * Syy) - (Sxy ** 2)
+    traceH = Sxx + Syy
+    return detH - Alpha * (traceH ** 2)
 
 
 def get_features(image, x, y, feature_width):
@@ -139,56 +168,68 @@ def get_features(image, x, y, feature_width):
 
     """
     # convert inputs to integers
+    image = np.asarray(image, dtype=np.float32)
     x = np.round(x).astype(int)
     y = np.round(y).astype(int)
-    features = np.zeros((len(x), 4, 4, 8))
+    features = np.zeros((len(x), 128), dtype=np.float32)
     sigma = 0.8
-    filtered_image = gaussian(image, sigma)
-    dx = scharr_v(filtered_image)
-    dy = scharr_h(filtered_image)
-    grad = np.sqrt(np.square(dx) + np.square(dy))
-    thetas = np.arctan2(dy, dx)
-    thetas[thetas < 0] += 2 * np.pi
-    for m, (cor_x, cor_y) in enumerate(zip(x, y)):
-        # getting the window to wirk on
-        rows = (cor_x - (feature_width / 2 - 1), x + feature_width / 2)
-        if rows[0] < 0:
-            rows = (0, rows[1] - rows[0])
-        if (rows[1] >= image.shape[0]).all():
-            rows = (rows[0] + (image.shape[0] - 1 - rows[1]), image.shape[0] - 1)
-        cols = (cor_y - (feature_width / 2 - 1), y + feature_width / 2)
-        if cols[0] < 0:
-            cols = (0, cols[1] - cols[0])
-        if (cols[1] >= image.shape[1]).all():
-            cols = (cols[0] - (cols[1] + 1 - image.shape[1]), image.shape[1] - 1)
-        # square of features
-        i1 = int(rows[0])
-        i2 = rows[1].astype(int) + 1
-        j1 = int(cols[0])
-        j2 = cols[1].astype(int) + 1
-        grad_w = grad[i1:i2[-1], j1:j2[-1]]
-        theta_w = thetas[i1:i2[-1], j1:j2[-1]]
-        for i in range(int(feature_width / 4)):
-            for j in range(int(feature_width / 4)):
-                current_grad = grad_w[int(i * feature_width / 4): int((i + 1) * feature_width / 4),
-                               int(j * feature_width / 4): int((j + 1) * feature_width / 4)]
-                current_grad = current_grad.flatten()
-                current_theta = theta_w[int(i * feature_width / 4): int((i + 1) * feature_width / 4),
-                                int(j * feature_width / 4): int((j + 1) * feature_width / 4)]
-                current_theta = current_theta.flatten()
-                features[m, i, j] = np.histogram(current_theta, bins=8,
-                                                 range=(0, 2 * np.pi), weights=current_grad)[0]
-    features = features.reshape((len(x), -1,))
-    dev = np.linalg.norm(features, axis=1).reshape(-1, 1)
+    filtered_image = cv2.GaussianBlur(image, (0, 0), sigmaX=sigma, borderType=cv2.BORDER_REFLECT)
+    dx = cv2.Scharr(filtered_image, cv2.CV_32F, 1, 0)
+    dy = cv2.Scharr(filtered_image, cv2.CV_32F, 0, 1)
+    grad, bins = _gradient_bins(dx, dy)
+    _accumulate_histograms(grad, bins, x, y, feature_width, features)
+    dev = np.linalg.norm(features, axis=1, keepdims=True)
     dev[dev == 0] = 1  # to avoid deviding by zero
-    features = features / dev
+    np.divide(features, dev, out=features)
     threshold = 0.3
-    features[features >= threshold] = threshold
-    features = features ** 0.8
+    np.minimum(features, threshold, out=features)
+    np.power(features, 0.8, out=features)
 
     return features
 
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _gradient_bins(dx, dy):
+    """
+    Returns the gradient magnitude and the orientation bin (8 equal bins over
+    [0, 2 * pi)) of every pixel, both computed in a single pass over dx and dy.
+    """
+    rows, columns = dx.shape
+    grad = np.empty((rows, columns), dtype=dx.dtype)
+    bins = np.empty((rows, columns), dtype=np.int32)
+    for r in prange(rows):
+        for c in range(columns):
+            grad[r, c] = np.sqrt(dx[r, c] * dx[r, c] + dy[r, c] * dy[r, c])
+            theta = np.arctan2(dy[r, c], dx[r, c])
+            if theta < 0:
+                theta += 2 * np.pi
+            bins[r, c] = min(int(theta * (4 / np.pi)), 7)
+    return grad, bins
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _accumulate_histograms(grad, bins, x, y, feature_width, features):
+    """
+    Fills row m of features with the 4x4 grid of gradient weighted histograms of the
+    orientation bins in the feature_width square window around (x[m], y[m]), cell
+    (i, j) taking columns 8 * (4 * i + j) to 8 * (4 * i + j) + 7.
+    Windows reaching over the image border are shifted back inside so every
+    cell keeps its full size.
+    """
+    rows, columns = grad.shape
+    # offsets of the cell boundaries inside a window
+    edges = np.arange(5) * (feature_width // 4)
+    for m in prange(len(x)):
+        y0 = min(max(y[m] - (feature_width // 2 - 1), 0), rows - feature_width)
+        x0 = min(max(x[m] - (feature_width // 2 - 1), 0), columns - feature_width)
+        for i in range(4):
+            for j in range(4):
+                offset = 8 * (4 * i + j)
+                for r in range(y0 + edges[i], y0 + edges[i + 1]):
+                    for c in range(x0 + edges[j], x0 + edges[j + 1]):
+                        features[m, offset + bins[r, c]] += grad[r, c]
+
+
 def match_features(im1_features, im2_features):
     """
     Implements the Nearest Neighbor Distance Ratio Test to assign matches between interest points
@@ -224,23 +265,85 @@ def match_features(im1_features, im2_features):
 
     # These are placeholders - replace with your matches and confidences!
 
-    matches = []
-    confidences = []
+    # the squared distances to the two nearest features of the second image, in ascending order
+    distances, nearest = _two_nearest(im1_features, im2_features)
+    # If the ratio between the 2 smallest distances is less than 0.8
+    # add the smallest distance to the best matches, (0.8)^2 = 0.64 on squared distances
+    good = distances[:, 0] < 0.64 * distances[:, 1]
+    # without a second neighbour (infinite distance, or index -1 from faiss) there is no ratio to test
+    good &= np.isfinite(distances[:, 1]) & (nearest[:, 1] >= 0)
+    matches = np.stack((np.flatnonzero(good), nearest[good, 0]), axis=1)
+    # only the kept ratios need a square root
+    confidences = 1.0 - np.sqrt(distances[good, 0] / distances[good, 1])
 
-    # Loop over the number of features in the first image
-    for i in range(im1_features.shape[0]):
-        # Calculate the euclidean distance
-        distance = np.sqrt(((im1_features[i, :] - im2_features) ** 2).sum(axis=1))
+    return matches, confidences
 
-        # sort the distances in ascending order, while retaining the index of that distance
-        sorted_distances = np.argsort(distance)
-        # If the ratio between the 2 smallest distances is less than 0.8
-        # add the smallest distance to the best matches
-        if distance[sorted_distances[0]] < 0.8 * distance[sorted_distances[1]]:
-            matches.append([i, sorted_distances[0]])
-            confidences.append(1.0 - distance[sorted_distances[0]] / distance[sorted_distances[1]])
 
-    confidences = np.asarray(confidences)
-    confidences[np.isnan(confidences)] = np.min(confidences[~np.isnan(confidences)])
-
-    return np.array(matches), confidences
+def _two_nearest(im1_features, im2_features):
+    """
+    Returns the squared euclidean distances from every feature in im1_features to its
+    two nearest features in im2_features, in ascending order, and the indices of those
+    features. Uses a FAISS flat L2 index (on the GPU when one is available) if faiss is
+    installed, else OpenCV's CUDA brute force matcher when a CUDA device is available,
+    otherwise a single matrix product.
+    """
+    if faiss is not None:
+        im1_features = np.ascontiguousarray(im1_features, dtype=np.float32)
+        im2_features = np.ascontiguousarray(im2_features, dtype=np.float32)
+        index = faiss.IndexFlatL2(im2_features.shape[1])
+        if faiss.get_num_gpus() > 0:
+            index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, index)
+        index.add(im2_features)
+        return index.search(im1_features, 2)
+
+    if cv2.cuda.getCudaEnabledDeviceCount() > 0:
+        gpu_im1 = cv2.cuda_GpuMat()
+        gpu_im1.upload(np.float32(im1_features))
+        gpu_im2 = cv2.cuda_GpuMat()
+        gpu_im2.upload(np.float32(im2_features))
+        matcher = cv2.cuda.DescriptorMatcher_createBFMatcher(cv2.NORM_L2)
+        knn = matcher.knnMatch(gpu_im1, gpu_im2, k=2)
+        # a query gets fewer than 2 neighbours when im2_features has fewer than 2 rows,
+        # pad with an infinite distance and index -1 so match_features rejects it
+        distances = np.array([[m.distance for m in pair] + [np.inf] * (2 - len(pair)) for pair in knn],
+                             dtype=np.float32).reshape(-1, 2)
+        nearest = np.array([[m.trainIdx for m in pair] + [-1] * (2 - len(pair)) for pair in knn],
+                           dtype=np.int64).reshape(-1, 2)
+        return distances ** 2, nearest
+
+    # Calculate the squared euclidean distances block by block of block_size features,
+    # |a - b|^2 = |a|^2 + |b|^2 - 2ab so the bulk of the work is a matrix product per block
+    sq2 = np.einsum('ij,ij->i', im2_features, im2_features)
+    distances = np.empty((im1_features.shape[0], 2), dtype=np.result_type(im1_features, im2_features))
+    nearest = np.empty((im1_features.shape[0], 2), dtype=np.int64)
+    block_size = 4096
+    for start in range(0, im1_features.shape[0], block_size):
+        block = im1_features[start:start + block_size]
+        sq1 = np.einsum('ij,ij->i', block, block)
+        _two_smallest(sq1, sq2, block @ im2_features.T,
+                      distances[start:start + block_size], nearest[start:start + block_size])
+    return distances, nearest
+
+
+@njit(parallel=True, cache=True)
+def _two_smallest(sq1, sq2, products, distances, nearest):
+    """
+    Writes the two smallest squared distances sq1[i] + sq2[j] - 2 * products[i, j] of every
+    row i to distances[i], in ascending order, and their columns j to nearest[i].
+    """
+    for i in prange(products.shape[0]):
+        d0 = np.inf
+        d1 = np.inf
+        j0 = -1
+        j1 = -1
+        for j in range(products.shape[1]):
+            d = max(sq1[i] + sq2[j] - 2 * products[i, j], 0)
+            if d < d0:
+                d1, j1 = d0, j0
+                d0, j0 = d, j
+            elif d < d1:
+                d1, j1 = d, j
+        distances[i, 0] = d0
+        distances[i, 1] = d1
+        nearest[i, 0] = j0
+        nearest[i, 1] = j1